@@ -1,6 +1,18 @@
+import array
+import collections
+import contextlib
+import functools
+import hashlib
+import importlib
 import itertools
+import mmap
 import os
 import pickle
+import queue
+import stat
+import struct
+import sys
+import threading
 import typing as t
 import warnings
 
@@ -21,26 +33,65 @@ def get_func_path(f):
         return f.__globals__["__file__"]
 
 
-def get_cache_dir(f, *args, cache_base=CACHE_BASE, **kwargs):
+def get_cache_dir(
+    f,
+    args,
+    kwargs,
+    cache_base=CACHE_BASE,
+    hash_contents=False,
+    path_stats=None,
+):
+    # args and kwargs are those of the call to f. They are passed as a tuple and
+    #   a dict, rather than splatted, so that they can't collide with the other
+    #   arguments to this function.
+    if path_stats is None:
+        path_stats = stat_paths(args + tuple(kwargs.values()))
     # Below I separate args into those arguments that are file paths
     #   and those which are not, then I hash these separately. I'm
     #   not sure why I did that.
     paths, non_paths = [], []
     for arg in args:
-        if isinstance(arg, str) and os.path.exists(arg):
+        if isinstance(arg, str) and arg in path_stats:
             paths.append(arg)
         else:
             non_paths.append(str(arg))
     hashed_paths = [get_hash(path) for path in paths]
     hashed_args = get_hash(",".join(non_paths))
+    hashed_contents = []
+    if hash_contents:
+        # the contents of files among args and kwargs are part of the key, so
+        #   editing a file leads to a different cache_dir
+        digests = [
+            get_file_digest(path)
+            for path, st in path_stats.items()
+            if stat.S_ISREG(st.st_mode)
+        ]
+        hashed_contents.append(get_hash(digests))
     kwargs = [f"{k}={v}" for k, v in kwargs.items()]
     hashed_kwargs = get_hash(",".join(kwargs))
     cache_dir = os.path.join(
-        cache_base, f.__name__, *hashed_paths, hashed_args, hashed_kwargs
+        cache_base,
+        f.__name__,
+        *hashed_paths,
+        hashed_args,
+        hashed_kwargs,
+        *hashed_contents,
     )
     return cache_dir
 
 
+def get_file_digest(path: str) -> str:
+    """Returns the sha256 hex digest of the contents of the file at `path`."""
+    with open(path, "rb") as inf:
+        if hasattr(hashlib, "file_digest"):
+            # Python >= 3.11: reads into the hash in C without holding the GIL
+            return hashlib.file_digest(inf, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for block in iter(lambda: inf.read(1 << 16), b""):
+            digest.update(block)
+        return digest.hexdigest()
+
+
 def get_f_hash_path(cache_dir):
     return os.path.join(cache_dir, "f_hash")
 
@@ -68,43 +119,152 @@ def get_cache_path(cache_dir):
 #     return finger_print(f) == f_hash
 
 
-def check_f_hash(f, cache_dir):
+def get_f_hash(f):
+    # Like check_f_hash(), this isn't really a hash: it's the modification time
+    #   of the file that contains f. It is called once, when f is decorated,
+    #   rather than on every call: the code that runs can't change after that
+    #   point even if the file on disk does.
+    f_path = get_func_path(f)
+    return str(os.stat(f_path).st_mtime_ns)
+
+
+def check_f_hash(f_hash, cache_dir):
     # (Malcolm 2023-10-04) This function should surely be renamed, it checks
     #   the file modification time rather than making a hash
     f_hash_path = get_f_hash_path(cache_dir)
     if not os.path.exists(f_hash_path):
         return False
     with open(f_hash_path, "r") as inf:
-        f_hash = inf.read().strip()
-    f_path = get_func_path(f)
-    mtime = str(os.path.getmtime(f_path))
-    return mtime == f_hash
+        cached_f_hash = inf.read().strip()
+    return cached_f_hash == f_hash
+
+
+def _stat_path(arg: t.Any) -> t.Optional[os.stat_result]:
+    if not isinstance(arg, str):
+        return None
+    try:
+        return os.stat(arg)
+    except (OSError, ValueError):
+        return None
+
+
+def stat_paths(values: t.Iterable[t.Any]) -> t.Dict[str, os.stat_result]:
+    """Stats each distinct string in `values` that is an existing path.
+
+    The decorators call this once per call of the decorated function and pass
+    the result to get_cache_dir() and check_cache() so that each path is only
+    stat-ed once.
+    """
+    path_stats = {}
+    for value in values:
+        if isinstance(value, str) and value not in path_stats:
+            st = _stat_path(value)
+            if st is not None:
+                path_stats[value] = st
+    return path_stats
+
+
+def _load_mmapped(cache_path: str, loads: t.Callable[[t.Any], t.Any]) -> t.Any:
+    # Caches are written once and read many times; mapping the file lets
+    #   `loads` read straight from the page cache instead of going through an
+    #   intermediate bytes object
+    with open(cache_path, "rb") as inf, mmap.mmap(
+        inf.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm, memoryview(mm) as view:
+        return loads(view)
+
+
+# Large buffers (e.g., bytearrays or numpy arrays) are pickled out-of-band
+#   (see PEP 574) so they don't need to be copied into the pickle stream. They
+#   are written after the main pickle, followed by their lengths, their count,
+#   and then _OOB_MAGIC. A pickle always ends with the STOP opcode (b"."), so
+#   caches without out-of-band buffers are plain pickles and can't be mistaken
+#   for this format.
+_OOB_MAGIC = b"cache_lib-oob-buffers\n"
+
+
+def _pickle_loads_with_buffers(view: memoryview) -> t.Any:
+    magic_start = len(view) - len(_OOB_MAGIC)
+    if view[magic_start:] != _OOB_MAGIC:
+        return pickle.loads(view)
+    count_start = magic_start - 8
+    (n_buffers,) = struct.unpack_from("<Q", view, count_start)
+    lengths_start = count_start - 8 * n_buffers
+    lengths = struct.unpack_from(f"<{n_buffers}Q", view, lengths_start)
+    buffers = []
+    end = lengths_start
+    for length in reversed(lengths):
+        # copy into bytearrays so the buffers outlive the mmap and so that,
+        #   e.g., numpy arrays are writeable as they would be if pickled in-band
+        buffers.append(bytearray(view[end - length : end]))
+        end -= length
+    buffers.reverse()
+    with view[:end] as main:
+        return pickle.loads(main, buffers=buffers)
 
 
 def default_read_cache_f(cache_path: str) -> t.Any:
-    with open(cache_path, "rb") as inf:
-        return pickle.load(inf)
+    return _load_mmapped(cache_path, _pickle_loads_with_buffers)
+
+
+def get_paths_mtimes(
+    path_stats: t.Dict[str, os.stat_result], hash_contents: bool = False
+) -> t.Tuple[int, ...]:
+    """Returns the mtimes of the paths whose modification invalidates the cache.
 
+    If hash_contents is True, regular files are skipped since their contents
+    are already part of the cache key.
+    """
+    return tuple(
+        st.st_mtime_ns
+        for st in path_stats.values()
+        if not (hash_contents and stat.S_ISREG(st.st_mode))
+    )
+
+
+def get_cache_mtime(cache_dir) -> t.Optional[int]:
+    """Returns the mtime in ns of the cache in cache_dir, or None if it's missing.
 
-def check_cache(cache_dir, f, *args, read_cache_sub=default_read_cache_f, **kwargs):
+    Only the files written by write_cache() count: the cache dir can also
+    contain temporary files from concurrent (or killed) writers.
+    """
+    try:
+        return min(
+            os.stat(path).st_mtime_ns
+            for path in (get_f_hash_path(cache_dir), get_cache_path(cache_dir))
+        )
+    except FileNotFoundError:
+        return None
+
+
+def check_cache(
+    cache_dir,
+    f_hash,
+    args,
+    kwargs,
+    read_cache_sub=default_read_cache_f,
+    hash_contents=False,
+    path_stats=None,
+):
     if not os.path.exists(cache_dir):
         return "CACHE_DOES_NOT_EXIST"
-    if not check_f_hash(f, cache_dir):
+    if not check_f_hash(f_hash, cache_dir):
         return "CACHE_DOES_NOT_EXIST"
 
-    paths = [
-        arg
-        for arg in (args + tuple(kwargs.values()))
-        if (isinstance(arg, str) and os.path.exists(arg))
-    ]
-    if paths:
-        paths_mtime = max(os.path.getmtime(p) for p in paths)
-        cache_mtime = min(
-            os.path.getmtime(os.path.join(cache_dir, p)) for p in os.listdir(cache_dir)
-        )
-        if cache_mtime <= paths_mtime:
+    if path_stats is None:
+        path_stats = stat_paths(args + tuple(kwargs.values()))
+    paths_mtimes = get_paths_mtimes(path_stats, hash_contents=hash_contents)
+    if paths_mtimes:
+        paths_mtime = max(paths_mtimes)
+        cache_mtime = get_cache_mtime(cache_dir)
+        if cache_mtime is None or cache_mtime <= paths_mtime:
             return "CACHE_DOES_NOT_EXIST"
     cache_path = get_cache_path(cache_dir)
+    # read_cache_sub may be lazy (as for iterator caches), in which case it
+    #   wouldn't raise below if the cache is missing (e.g., because writing it
+    #   failed)
+    if not os.path.exists(cache_path):
+        return "CACHE_DOES_NOT_EXIST"
     try:
         out = read_cache_sub(cache_path)
     except Exception as exc:
@@ -114,16 +274,202 @@ def check_cache(cache_dir, f, *args, read_cache_sub=default_read_cache_f, **kwar
 
 
 def default_write_cache_f(return_value: t.Any, cache_path: str) -> None:
+    buffers = []
+
+    def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+        try:
+            buffers.append(buffer.raw())
+        except BufferError:
+            # non-contiguous buffers can't be written out as-is; pickle them
+            #   in-band
+            return True
+        return False
+
     with open(cache_path, "wb") as outf:
-        pickle.dump(return_value, outf)
+        pickle.dump(
+            return_value,
+            outf,
+            protocol=pickle.HIGHEST_PROTOCOL,
+            buffer_callback=buffer_callback,
+        )
+        if buffers:
+            for buffer in buffers:
+                outf.write(buffer)
+            outf.write(
+                struct.pack(
+                    f"<{len(buffers) + 1}Q",
+                    *(buffer.nbytes for buffer in buffers),
+                    len(buffers),
+                )
+            )
+            outf.write(_OOB_MAGIC)
 
 
-def write_cache(cache_dir, f, return_value, write_cache_sub):
-    f_path = get_func_path(f)
-    mtime = str(os.path.getmtime(f_path))
+# Optional dependencies are imported the first time they are used (or accessed
+#   as attributes of this module, which gives None if they aren't installed)
+#   so that importing cache_lib stays cheap
+_OPTIONAL_MODULES = ("orjson", "msgpack", "diskcache")
+
+
+@functools.lru_cache(maxsize=None)
+def _import_optional(name: str):
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def __getattr__(name: str):
+    if name in _OPTIONAL_MODULES:
+        return _import_optional(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _require(name: str):
+    module = _import_optional(name)
+    if module is None:
+        raise ImportError(f"This requires {name}: `pip install {name}`")
+    return module
+
+
+def orjson_read_cache_f(cache_path: str) -> t.Any:
+    return _load_mmapped(cache_path, _require("orjson").loads)
+
+
+def orjson_write_cache_f(return_value: t.Any, cache_path: str) -> None:
+    dumps = _require("orjson").dumps
+    with open(cache_path, "wb") as outf:
+        outf.write(dumps(return_value))
+
+
+def msgpack_read_cache_f(cache_path: str) -> t.Any:
+    unpackb = _require("msgpack").unpackb
+    return _load_mmapped(cache_path, lambda data: unpackb(data, raw=False))
+
+
+def msgpack_write_cache_f(return_value: t.Any, cache_path: str) -> None:
+    packb = _require("msgpack").packb
+    with open(cache_path, "wb") as outf:
+        outf.write(packb(return_value, use_bin_type=True))
+
+
+# Maps the `serializer` argument of `cacher` to (write_cache_f, read_cache_f)
+SERIALIZERS = {
+    "pickle": (default_write_cache_f, default_read_cache_f),
+    "orjson": (orjson_write_cache_f, orjson_read_cache_f),
+    "msgpack": (msgpack_write_cache_f, msgpack_read_cache_f),
+}
+
+
+def write_cache(cache_dir, f_hash, return_value, write_cache_sub):
     with open(get_f_hash_path(cache_dir), "w") as outf:
-        outf.write(mtime)
-    write_cache_sub(return_value, get_cache_path(cache_dir))
+        outf.write(f_hash)
+    cache_path = get_cache_path(cache_dir)
+    # We write to a temporary file and then rename it into place so that readers
+    #   never see a partially written cache (e.g., if another process reads it
+    #   concurrently or if writing fails part way through). Renaming doesn't copy
+    #   any data.
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write_cache_sub(return_value, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+# Seconds to wait for a shard's sqlite lock before giving up on a read or write
+DISKCACHE_TIMEOUT = 60
+
+
+@functools.lru_cache(maxsize=None)
+def get_fanout_cache(cache_base: str):
+    """Returns the diskcache.FanoutCache used by the "diskcache" backend.
+
+    There is one FanoutCache per cache_base, shared by all decorated functions.
+    It is sharded so that concurrent writers mostly don't contend for the same
+    sqlite database. Like the "files" backend, it never evicts anything (by
+    default, diskcache evicts entries beyond 1 GB, split evenly between shards,
+    so a single large value might never be cached).
+    """
+    diskcache = _require("diskcache")
+    return diskcache.FanoutCache(
+        os.path.join(cache_base, "diskcache"),
+        shards=8,
+        timeout=DISKCACHE_TIMEOUT,
+        eviction_policy="none",
+    )
+
+
+def check_diskcache(fanout_cache, key, f_hash, paths_mtimes):
+    # Rather than comparing mtimes of the cache against those of the paths, as
+    #   check_cache() does, we store the mtimes that the paths had when the
+    #   value was computed and require them to be unchanged
+    try:
+        entry = fanout_cache.get(key)
+    except Exception as exc:
+        print(f"Error loading cache: {exc}")
+        return "CACHE_DOES_NOT_EXIST"
+    if entry is None:
+        return "CACHE_DOES_NOT_EXIST"
+    cached_f_hash, cached_paths_mtimes, out = entry
+    if cached_f_hash != f_hash or cached_paths_mtimes != paths_mtimes:
+        return "CACHE_DOES_NOT_EXIST"
+    return out
+
+
+def write_diskcache(fanout_cache, key, f_hash, paths_mtimes, return_value):
+    # FanoutCache.set() returns False rather than raising if it times out
+    if not fanout_cache.set(key, (f_hash, paths_mtimes, return_value)):
+        warnings.warn(f"Timed out writing cache for {key}")
+
+
+BACKENDS = ("files", "diskcache")
+
+
+def check_memory_entry(entry, paths_mtimes):
+    # Memory cache entries are (cache_mtime, paths_mtimes, value). They are
+    #   checked with the same rule as the backend they were read from or written
+    #   to: for the "files" backend, cache_mtime is the mtime of the cache files
+    #   and, as in check_cache(), every path has to be older than it; for the
+    #   "diskcache" backend, cache_mtime is None and, as in check_diskcache(),
+    #   the mtimes of the paths have to be unchanged.
+    cache_mtime, cached_paths_mtimes, value = entry
+    if cache_mtime is None:
+        if cached_paths_mtimes != paths_mtimes:
+            return "CACHE_DOES_NOT_EXIST"
+    elif any(mtime >= cache_mtime for mtime in paths_mtimes):
+        return "CACHE_DOES_NOT_EXIST"
+    return value
+
+
+# The default memory_cache_size for cacher(pure=True)
+PURE_MEMORY_CACHE_SIZE = 128
+
+
+class _MemoryCache:
+    """A thread-safe in-memory LRU cache used in front of the disk cache."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
 
 
 def cacher(
@@ -131,6 +477,11 @@ def cacher(
     read_cache_f: t.Callable[[str], t.Any] = default_read_cache_f,
     cache_base: str = CACHE_BASE,
     warn_on_cache_use: bool = False,
+    serializer: t.Optional[str] = None,
+    hash_contents: bool = False,
+    memory_cache_size: int = 0,
+    backend: str = "files",
+    pure: bool = False,
 ):
     """A decorator for caching the results of function calls.
 
@@ -152,25 +503,115 @@ def cacher(
             If this function is provided then read_cache_f should probably also
             be provided.
         read_cache_f: a callable that takes a path and reads the cache from it.
+        serializer: one of "pickle", "orjson", or "msgpack". If provided,
+            overrides write_cache_f and read_cache_f with the corresponding
+            pair from SERIALIZERS. "orjson" and "msgpack" are much faster than
+            pickle but only handle JSON-like values and require the
+            respective package to be installed.
+        hash_contents: if True, files in args and kwargs are identified by a
+            hash of their contents rather than by their modification times, so
+            touching a file without changing it doesn't invalidate the cache.
+            Hashing is slower than checking modification times for large files.
+        memory_cache_size: if positive, the results of up to this many of the
+            most recent calls are also kept in memory, so repeated calls don't
+            need to read and deserialize the cache from disk. Path arguments
+            are still checked for modifications. Note that a result returned
+            from memory is the same object each time, so callers shouldn't
+            mutate it.
+        backend: either "files" (the default), which stores each cache in its
+            own directory inside cache_base, or "diskcache", which stores caches
+            in a sharded diskcache.FanoutCache inside cache_base. The latter
+            scales better when decorated functions are called concurrently from
+            many threads or processes. It requires diskcache to be installed and
+            ignores write_cache_f, read_cache_f, and serializer (diskcache
+            pickles values itself). Neither backend evicts old caches; writes
+            to diskcache that time out (see DISKCACHE_TIMEOUT) are skipped with
+            a warning.
+        pure: if True, the result of the decorated function is assumed to depend
+            only on its arguments: str arguments aren't treated as paths (so
+            they aren't checked for modification) and results are also kept in
+            memory, as with memory_cache_size (which defaults to
+            PURE_MEMORY_CACHE_SIZE in this case), so that repeated calls don't
+            touch the disk at all. Callers shouldn't mutate the returned values.
     """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {list(BACKENDS)}, got {backend!r}")
+    if serializer is not None:
+        try:
+            write_cache_f, read_cache_f = SERIALIZERS[serializer]
+        except KeyError:
+            raise ValueError(
+                f"serializer must be one of {list(SERIALIZERS)}, got {serializer!r}"
+            )
 
     def wrap(f):
         if NO_CACHE is not None:
             warnings.warn(f"NO_CACHE is set, caching of {f.__name__} will be disabled")
             return f
 
+        f_hash = get_f_hash(f)
+        fanout_cache = get_fanout_cache(cache_base) if backend == "diskcache" else None
+        memory_size = memory_cache_size
+        if pure and memory_size <= 0:
+            # Results only depend on the arguments, so within a process we can
+            #   skip reading the disk for calls we've already seen
+            memory_size = PURE_MEMORY_CACHE_SIZE
+        memory_cache = _MemoryCache(memory_size) if memory_size > 0 else None
+
         def f1(*args, **kwargs):
-            cache_dir = get_cache_dir(f, *args, cache_base=cache_base, **kwargs)
-            cached = check_cache(
-                cache_dir, f, *args, read_cache_sub=read_cache_f, **kwargs
+            path_stats = {} if pure else stat_paths(args + tuple(kwargs.values()))
+            cache_dir = get_cache_dir(
+                f,
+                args,
+                kwargs,
+                cache_base=cache_base,
+                hash_contents=hash_contents,
+                path_stats=path_stats,
             )
+            paths_mtimes = get_paths_mtimes(path_stats, hash_contents=hash_contents)
+            if memory_cache is not None:
+                entry = memory_cache.get(cache_dir)
+                if entry is not None:
+                    cached = check_memory_entry(entry, paths_mtimes)
+                    if cached != "CACHE_DOES_NOT_EXIST":
+                        if warn_on_cache_use:
+                            warnings.warn("Using cache")
+                        return cached
+
+            def remember(value):
+                if memory_cache is None:
+                    return
+                if fanout_cache is not None:
+                    memory_cache.put(cache_dir, (None, paths_mtimes, value))
+                    return
+                cache_mtime = get_cache_mtime(cache_dir)
+                if cache_mtime is not None:
+                    memory_cache.put(cache_dir, (cache_mtime, paths_mtimes, value))
+
+            if fanout_cache is not None:
+                cached = check_diskcache(fanout_cache, cache_dir, f_hash, paths_mtimes)
+            else:
+                cached = check_cache(
+                    cache_dir,
+                    f_hash,
+                    args,
+                    kwargs,
+                    read_cache_sub=read_cache_f,
+                    hash_contents=hash_contents,
+                    path_stats=path_stats,
+                )
             if cached != "CACHE_DOES_NOT_EXIST":
                 if warn_on_cache_use:
                     warnings.warn("Using cache")
+                remember(cached)
                 return cached
             out = f(*args, **kwargs)
-            os.makedirs(cache_dir, exist_ok=True)
-            write_cache(cache_dir, f, out, write_cache_f)
+            if fanout_cache is not None:
+                write_diskcache(fanout_cache, cache_dir, f_hash, paths_mtimes, out)
+            else:
+                os.makedirs(cache_dir, exist_ok=True)
+                write_cache(cache_dir, f_hash, out, write_cache_f)
+            remember(out)
             return out
 
         return f1
@@ -178,9 +619,40 @@ def cacher(
     return wrap
 
 
+# Iterator caches are written item by item, so we buffer writes to avoid
+#   a write syscall per item
+ITERATOR_BUFFER_SIZE = 1 << 20
+
+
+# Iterators that only yield ints that fit in 64 bits are written as _INT64_MAGIC
+#   followed by a little-endian int64 array, which is much faster to write and
+#   read than pickling each int. Pickle streams written with protocol >= 2
+#   start with b"\x80" so they can't be mistaken for this format.
+_INT64_MAGIC = b"cache_lib-int64-le\n"
+
+
 def default_iterator_read_cache_f(cache_path: str) -> t.Iterator[t.Any]:
-    with open(cache_path, "rb") as inf:
+    with open(cache_path, "rb", buffering=ITERATOR_BUFFER_SIZE) as inf:
+        if inf.read(len(_INT64_MAGIC)) == _INT64_MAGIC:
+            # Read a block at a time so that values are still read lazily
+            block_size = ITERATOR_BUFFER_SIZE // array.array("q").itemsize
+            while True:
+                ints = array.array("q")
+                try:
+                    ints.fromfile(inf, block_size)
+                    done = False
+                except EOFError:
+                    # the items before the end of the file are still read
+                    done = True
+                if sys.byteorder != "little":
+                    ints.byteswap()
+                yield from ints
+                if done:
+                    return
+        inf.seek(0)
         while True:
+            # Each value is a separate pickle with its own memo, so we can't
+            #   reuse an Unpickler (its memo persists between calls to load())
             try:
                 yield pickle.load(inf)
             except EOFError:
@@ -188,9 +660,116 @@ def default_iterator_read_cache_f(cache_path: str) -> t.Iterator[t.Any]:
 
 
 def default_iterator_write_cache_f(values: t.Iterator[t.Any], cache_path: str) -> None:
+    values = iter(values)
+    ints = array.array("q")
+    for value in values:
+        # bools are ints too, but they need to be read back as bools
+        if type(value) is int:
+            try:
+                ints.append(value)
+                continue
+            except OverflowError:
+                pass
+        # not every value is an int64: pickle everything instead
+        _pickle_iterator(itertools.chain(ints, [value], values), cache_path)
+        return
+    if not ints:
+        # an empty file is an empty pickle stream
+        open(cache_path, "wb").close()
+        return
+    if sys.byteorder != "little":
+        ints.byteswap()
     with open(cache_path, "wb") as outf:
+        outf.write(_INT64_MAGIC)
+        ints.tofile(outf)
+
+
+def _pickle_iterator(values: t.Iterator[t.Any], cache_path: str) -> None:
+    with open(cache_path, "wb", buffering=ITERATOR_BUFFER_SIZE) as outf:
+        pickler = pickle.Pickler(outf, protocol=pickle.HIGHEST_PROTOCOL)
+        for value in values:
+            pickler.dump(value)
+            # Each value has to be readable on its own, so values can't refer
+            #   back to objects memoized while pickling previous values
+            pickler.clear_memo()
+
+
+def msgpack_iterator_read_cache_f(cache_path: str) -> t.Iterator[t.Any]:
+    Unpacker = _require("msgpack").Unpacker
+    with open(cache_path, "rb", buffering=ITERATOR_BUFFER_SIZE) as inf:
+        yield from Unpacker(inf, raw=False)
+
+
+def msgpack_iterator_write_cache_f(values: t.Iterator[t.Any], cache_path: str) -> None:
+    packer = _require("msgpack").Packer(use_bin_type=True)
+    with open(cache_path, "wb", buffering=ITERATOR_BUFFER_SIZE) as outf:
         for value in values:
-            pickle.dump(value, outf)
+            outf.write(packer.pack(value))
+
+
+# Maps the `serializer` argument of `iterator_cacher` to
+#   (write_cache_f, read_cache_f)
+ITERATOR_SERIALIZERS = {
+    "pickle": (default_iterator_write_cache_f, default_iterator_read_cache_f),
+    "msgpack": (msgpack_iterator_write_cache_f, msgpack_iterator_read_cache_f),
+}
+
+
+_PREFETCH_ITEM, _PREFETCH_ERROR, _PREFETCH_DONE = range(3)
+
+
+def prefetch_iterator(
+    iterator: t.Iterator[t.Any], buffer_size: int = 64
+) -> t.Iterator[t.Any]:
+    """Yields the items of `iterator`, reading up to `buffer_size` items ahead
+    in a background thread.
+
+    This lets the consumer's work overlap with reading (and deserializing)
+    the next items. Exceptions raised by `iterator` are re-raised in the
+    consumer. If the consumer stops early, the background thread stops and
+    closes `iterator`.
+
+    >>> list(prefetch_iterator(iter(range(5)), buffer_size=2))
+    [0, 1, 2, 3, 4]
+    """
+    items = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+
+    def put(message):
+        while not stop.is_set():
+            try:
+                items.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put((_PREFETCH_ITEM, item)):
+                    return
+        except BaseException as exc:
+            put((_PREFETCH_ERROR, exc))
+        else:
+            put((_PREFETCH_DONE, None))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == _PREFETCH_DONE:
+                return
+            if kind == _PREFETCH_ERROR:
+                raise value
+            yield value
+    finally:
+        stop.set()
 
 
 def iterator_cacher(
@@ -199,22 +778,58 @@ def iterator_cacher(
     ] = default_iterator_write_cache_f,
     read_cache_f: t.Callable[[str], t.Iterator[t.Any]] = default_iterator_read_cache_f,
     cache_base: str = CACHE_BASE,
+    serializer: t.Optional[str] = None,
+    prefetch: int = 0,
 ):
+    """Like cacher, but for functions that return iterators.
+
+    The values yielded by the decorated function are written to the cache one
+    at a time and read back lazily.
+
+    Keyword args:
+        serializer: one of "pickle" or "msgpack". If provided, overrides
+            write_cache_f and read_cache_f with the corresponding pair from
+            ITERATOR_SERIALIZERS.
+        prefetch: if positive, cached values are read up to this many items
+            ahead in a background thread (see prefetch_iterator). Useful when
+            the consumer does non-trivial work per item.
+    """
+    if serializer is not None:
+        try:
+            write_cache_f, read_cache_f = ITERATOR_SERIALIZERS[serializer]
+        except KeyError:
+            raise ValueError(
+                f"serializer must be one of {list(ITERATOR_SERIALIZERS)}, "
+                f"got {serializer!r}"
+            )
+
     def wrap(f):
         if NO_CACHE is not None:
             warnings.warn(f"NO_CACHE is set, caching of {f.__name__} will be disabled")
             return f
 
+        f_hash = get_f_hash(f)
+
         def f1(*args, **kwargs):
-            cache_dir = get_cache_dir(f, *args, cache_base=cache_base, **kwargs)
+            path_stats = stat_paths(args + tuple(kwargs.values()))
+            cache_dir = get_cache_dir(
+                f, args, kwargs, cache_base=cache_base, path_stats=path_stats
+            )
             cached = check_cache(
-                cache_dir, f, *args, read_cache_sub=read_cache_f, **kwargs
+                cache_dir,
+                f_hash,
+                args,
+                kwargs,
+                read_cache_sub=read_cache_f,
+                path_stats=path_stats,
             )
             if cached != "CACHE_DOES_NOT_EXIST":
+                if prefetch > 0:
+                    return prefetch_iterator(cached, buffer_size=prefetch)
                 return cached
             out, to_cache = itertools.tee(f(*args, **kwargs))
             os.makedirs(cache_dir, exist_ok=True)
-            write_cache(cache_dir, f, to_cache, write_cache_f)
+            write_cache(cache_dir, f_hash, to_cache, write_cache_f)
             return out
 
         return f1
@@ -9,7 +9,6 @@ the hash changing. Empty means one of: None, '', (), [], or {}.
 The dataclass type is ignored: two instances of different types
 will have the same hash if they have the same attribute/value pairs.
 """
-import dataclasses
 import datetime
 import hashlib
 import json
@@ -34,7 +33,11 @@ _EXCLUDE = "_hash_exclude_"
 
 
 def get_hash(thing: object) -> bytes:
-    digest = hashlib.md5(_json_dumps(thing).encode("utf-8")).hexdigest()
+    # blake2b is in the standard library and is faster than md5 for the short
+    #   strings we hash here
+    digest = hashlib.blake2b(
+        _json_dumps(thing).encode("utf-8"), digest_size=16
+    ).hexdigest()
     return digest[:-1]
 
 
@@ -69,6 +72,11 @@ def _dataclass_dict(thing: object) -> Dict[str, Any]:
     # the _hash_exclude_ of nested dataclasses;
     # this way, json.dumps() does the recursion instead of asdict()
 
+    # dataclasses is imported here rather than at the top of the module because
+    # it imports inspect, which is slow to import, and we only need it for
+    # objects json can't serialize by itself
+    import dataclasses
+
     # raises TypeError for non-dataclasses
     fields = dataclasses.fields(thing)
     # ... but doesn't for dataclass *types*
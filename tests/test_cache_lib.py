@@ -1,10 +1,13 @@
 import json
+import pytest
 import subprocess
 import os
+import sys
 import shutil
 import time
 import tempfile
-from pathlib import Path
+import threading
+from pickle import PickleBuffer
 
 from cache_lib import cacher, iterator_cacher
 from cache_lib.cache_lib import (
@@ -13,6 +16,23 @@ from cache_lib.cache_lib import (
     default_write_cache_f,
     default_iterator_read_cache_f,
     default_iterator_write_cache_f,
+    ITERATOR_BUFFER_SIZE,
+    orjson,
+    orjson_read_cache_f,
+    orjson_write_cache_f,
+    msgpack,
+    msgpack_read_cache_f,
+    msgpack_write_cache_f,
+    msgpack_iterator_read_cache_f,
+    msgpack_iterator_write_cache_f,
+    prefetch_iterator,
+    diskcache,
+)
+
+_THIS_FILE = os.path.realpath(__file__)
+_THIS_DIR = os.path.dirname(_THIS_FILE)
+_CACHE_LIB_PY = os.path.realpath(
+    os.path.join(_THIS_DIR, "..", "cache_lib", "cache_lib.py")
 )
 
 
@@ -20,15 +40,17 @@ def test_get_func_path():
     def f():
         pass
 
-    assert get_func_path(f) == os.path.realpath(__file__)
-    assert os.path.samefile(
-        get_func_path(cacher),
-        os.path.join(
-            os.path.realpath(os.path.dirname(__file__)),
-            "..",
-            "cache_lib",
-            "cache_lib.py",
-        ),
+    assert get_func_path(f) == _THIS_FILE
+    assert os.path.samefile(get_func_path(cacher), _CACHE_LIB_PY)
+
+
+@pytest.fixture
+def input_paths(tmp_path):
+    # Paths for input files; tests write them with _make_temp_file() before use
+    inputs_dir = tmp_path / "inputs"
+    inputs_dir.mkdir()
+    return tuple(
+        str(inputs_dir / name) for name in ("path1", "path2", "kwargpath")
     )
 
 
@@ -38,6 +60,25 @@ def _make_temp_file(path):
         outf.write(f_contents)
 
 
+def test_default_cache_f_out_of_band_buffers(tmp_path):
+    cache_path = str(tmp_path / "cache")
+    # objects like numpy arrays reduce to PickleBuffers, which are pickled
+    #   out-of-band; they are loaded as the underlying buffer
+    for value, expected in (
+        (
+            {"a": PickleBuffer(bytearray(b"abc" * 1000)), "b": 1},
+            {"a": bytearray(b"abc" * 1000), "b": 1},
+        ),
+        (
+            [PickleBuffer(bytearray()), PickleBuffer(bytearray(b"e"))],
+            [bytearray(), bytearray(b"e")],
+        ),
+        ({"a": b"in-band", "b": None}, {"a": b"in-band", "b": None}),
+    ):
+        default_write_cache_f(value, cache_path)
+        assert default_read_cache_f(cache_path) == expected
+
+
 def _json_read_cache_f(cache_path):
     with open(cache_path, "r") as inf:
         return json.load(inf)
@@ -48,98 +89,250 @@ def _json_write_cache_f(return_value, cache_path):
         json.dump(return_value, outf)
 
 
-def test_cacher():
-    for read_f, write_f in (
-        (_json_read_cache_f, _json_write_cache_f),
-        (default_read_cache_f, default_write_cache_f),
-    ):
-        temp_dir = tempfile.mkdtemp()
-        _, path1 = tempfile.mkstemp()
-        _, path2 = tempfile.mkstemp()
-        _, kwargpath = tempfile.mkstemp()
+# orjson, msgpack, and diskcache are optional dependencies
+CACHER_KWARGS = [
+    pytest.param(
+        dict(
+            read_cache_f=_json_read_cache_f, write_cache_f=_json_write_cache_f
+        ),
+        id="json",
+    ),
+    pytest.param(
+        dict(
+            read_cache_f=default_read_cache_f,
+            write_cache_f=default_write_cache_f,
+        ),
+        id="default",
+    ),
+    pytest.param(
+        dict(
+            read_cache_f=orjson_read_cache_f,
+            write_cache_f=orjson_write_cache_f,
+        ),
+        id="orjson",
+        marks=pytest.mark.skipif(orjson is None, reason="needs orjson"),
+    ),
+    pytest.param(
+        dict(
+            read_cache_f=msgpack_read_cache_f,
+            write_cache_f=msgpack_write_cache_f,
+        ),
+        id="msgpack",
+        marks=pytest.mark.skipif(msgpack is None, reason="needs msgpack"),
+    ),
+    pytest.param(
+        dict(backend="diskcache"),
+        id="diskcache",
+        marks=pytest.mark.skipif(diskcache is None, reason="needs diskcache"),
+    ),
+]
+
+
+@pytest.mark.parametrize("cacher_kwargs", CACHER_KWARGS)
+def test_cacher(cacher_kwargs, input_paths, tmp_path):
+    path1, path2, kwargpath = input_paths
+    temp_dir = str(tmp_path / "cache")
+
+    f_execution_times = {}
+
+    @cacher(cache_base=temp_dir, **cacher_kwargs)
+    def f(path, kwargpath=None):
+        f_execution_times[path] = time.time()
+        with open(path, "r") as inf:
+            out = inf.read()
+        if kwargpath is not None:
+            with open(kwargpath, "r") as inf:
+                out += inf.read()
+        return out
+
+    _make_temp_file(path1)
+    _make_temp_file(path2)
+    _make_temp_file(kwargpath)
+    f1_contents = f(path1)
+    f2_contents = f(path2, kwargpath=kwargpath)
+
+    # f should execute for path2 as well
+    assert path2 in f_execution_times
+    assert f_execution_times[path1] != f_execution_times[path2]
+
+    f_last_ran_for_path1 = f_execution_times[path1]
+    f_last_ran_for_path2 = f_execution_times[path2]
+
+    # file 1 has not changed, f should not execute
+    f1_contents_again = f(path1)
+    assert f_execution_times[path1] == f_last_ran_for_path1
+    assert f1_contents_again == f1_contents
+
+    # touch file 2, f should execute
+    os.utime(path2, None)
+    touched_f2_contents = f(path2, kwargpath=kwargpath)
+    assert f_execution_times[path2] != f_last_ran_for_path2
+    assert touched_f2_contents == f2_contents
+
+    f_last_ran_for_path2 = f_execution_times[path2]
+    # touch kwargpath, f should execute again
+    os.utime(kwargpath, None)
+    touched_again_f2_contents = f(path2, kwargpath=kwargpath)
+    assert f_execution_times[path2] != f_last_ran_for_path2
+    assert touched_again_f2_contents == f2_contents
+
+    _make_temp_file(path1)
+    changed_f1_contents = f(path1)
+    # file 2 has changed, f should execute
+    assert f_execution_times[path1] != f_last_ran_for_path1
+    assert changed_f1_contents != f1_contents
+
+    # # redefine f without changing it
+    # @cacher(cache_base=temp_dir)
+    # def f(path):
+    #     f_execution_times[path] = time.time()
+    #     with open(path, "r") as inf:
+    #         return inf.read()
+
+    # # f has not changed, contents should be same
+    # redefined_f1_contents = f(path1)
+    # assert f_execution_times[path1] == f_last_ran_for_path1
+    # assert redefined_f1_contents == f1_contents
+
+    # redefine f and change it
+    @cacher(cache_base=temp_dir, **cacher_kwargs)
+    def f(path):
+        pointless_statement = None
+        f_execution_times[path] = time.time()
+        with open(path, "r") as inf:
+            return inf.read()
+
+    changed_f_f1_contents = f(path1)
+    assert f_execution_times[path1] != f_last_ran_for_path1
+    assert changed_f_f1_contents != f1_contents
+
+
+@pytest.mark.skipif(diskcache is None, reason="needs diskcache")
+def test_cacher_diskcache_write_timeout(monkeypatch, tmp_path):
+    # FanoutCache.set() returns False when it times out
+    monkeypatch.setattr(diskcache.FanoutCache, "set", lambda *args: False)
+
+    @cacher(cache_base=str(tmp_path), backend="diskcache")
+    def f(x):
+        return [x]
+
+    with pytest.warns(UserWarning, match="Timed out"):
+        assert f(1) == [1]
+
+
+def test_cacher_hash_contents(tmp_path):
+    path = str(tmp_path / "input")
+    calls = []
+
+    @cacher(cache_base=str(tmp_path / "cache"), hash_contents=True)
+    def f(path):
+        calls.append(path)
+        with open(path, "r") as inf:
+            return inf.read()
+
+    _make_temp_file(path)
+    contents = f(path)
+    assert len(calls) == 1
+
+    # touching the file without changing it doesn't invalidate the cache
+    os.utime(path, None)
+    assert f(path) == contents
+    assert len(calls) == 1
 
-        try:
-            f_execution_times = {}
+    with open(path, "w") as outf:
+        outf.write("new contents")
+    assert f(path) == "new contents"
+    assert len(calls) == 2
 
-            @cacher(
-                cache_base=temp_dir, write_cache_f=write_f, read_cache_f=read_f
-            )
-            def f(path, kwargpath=None):
-                f_execution_times[path] = time.time()
-                with open(path, "r") as inf:
-                    out = inf.read()
-                if kwargpath is not None:
-                    with open(kwargpath, "r") as inf:
-                        out += inf.read()
-                return out
-
-            _make_temp_file(path1)
-            _make_temp_file(path2)
-            _make_temp_file(kwargpath)
-            f1_contents = f(path1)
-            f2_contents = f(path2, kwargpath=kwargpath)
-
-            # f should execute for path2 as well
-            assert path2 in f_execution_times
-            assert f_execution_times[path1] != f_execution_times[path2]
-
-            f_last_ran_for_path1 = f_execution_times[path1]
-            f_last_ran_for_path2 = f_execution_times[path2]
-
-            # file 1 has not changed, f should not execute
-            f1_contents_again = f(path1)
-            assert f_execution_times[path1] == f_last_ran_for_path1
-            assert f1_contents_again == f1_contents
-
-            # touch file 2, f should execute
-            Path(path2).touch()
-            touched_f2_contents = f(path2, kwargpath=kwargpath)
-            assert f_execution_times[path2] != f_last_ran_for_path2
-            assert touched_f2_contents == f2_contents
-
-            f_last_ran_for_path2 = f_execution_times[path2]
-            # touch kwargpath, f should execute again
-            Path(kwargpath).touch()
-            touched_again_f2_contents = f(path2, kwargpath=kwargpath)
-            assert f_execution_times[path2] != f_last_ran_for_path2
-            assert touched_again_f2_contents == f2_contents
-
-            _make_temp_file(path1)
-            changed_f1_contents = f(path1)
-            # file 2 has changed, f should execute
-            assert f_execution_times[path1] != f_last_ran_for_path1
-            assert changed_f1_contents != f1_contents
-
-            # # redefine f without changing it
-            # @cacher(cache_base=temp_dir)
-            # def f(path):
-            #     f_execution_times[path] = time.time()
-            #     with open(path, "r") as inf:
-            #         return inf.read()
-
-            # # f has not changed, contents should be same
-            # redefined_f1_contents = f(path1)
-            # assert f_execution_times[path1] == f_last_ran_for_path1
-            # assert redefined_f1_contents == f1_contents
-
-            # redefine f and change it
-            @cacher(
-                cache_base=temp_dir, write_cache_f=write_f, read_cache_f=read_f
-            )
-            def f(path):
-                pointless_statement = None
-                f_execution_times[path] = time.time()
-                with open(path, "r") as inf:
-                    return inf.read()
-
-            changed_f_f1_contents = f(path1)
-            assert f_execution_times[path1] != f_last_ran_for_path1
-            assert changed_f_f1_contents != f1_contents
-        finally:
-            os.remove(path1)
-            os.remove(path2)
-            os.remove(kwargpath)
-            shutil.rmtree(temp_dir)
+
+def _counting_read_cache_f(reads):
+    # Wraps default_read_cache_f to record each read from disk in reads
+    def read_f(cache_path):
+        reads.append(cache_path)
+        return default_read_cache_f(cache_path)
+
+    return read_f
+
+
+def test_cacher_memory_cache(input_paths, tmp_path):
+    path1, path2, _ = input_paths
+    calls, reads = [], []
+    read_f = _counting_read_cache_f(reads)
+
+    @cacher(cache_base=str(tmp_path), read_cache_f=read_f, memory_cache_size=1)
+    def f(path):
+        calls.append(path)
+        with open(path, "r") as inf:
+            return inf.read()
+
+    _make_temp_file(path1)
+    _make_temp_file(path2)
+    f1_contents = f(path1)
+    assert f(path1) == f1_contents
+    assert len(calls) == 1 and len(reads) == 0
+
+    # path1 is evicted from memory but is still cached on disk
+    f(path2)
+    assert f(path1) == f1_contents
+    assert len(calls) == 2 and len(reads) == 1
+
+    # touching path1 invalidates both the memory and the disk cache
+    os.utime(path1, None)
+    assert f(path1) == f1_contents
+    assert len(calls) == 3 and len(reads) == 1
+
+
+def test_cacher_pure(tmp_path):
+    calls, reads = [], []
+    read_f = _counting_read_cache_f(reads)
+
+    def decorate():
+        @cacher(cache_base=str(tmp_path), read_cache_f=read_f, pure=True)
+        def f(x, y=1):
+            calls.append(x)
+            return [x, y]
+
+        return f
+
+    f = decorate()
+    assert f(1, y=2) == f(1, y=2) == [1, 2]
+    assert len(calls) == 1 and len(reads) == 0
+
+    # unhashable arguments are memoized too
+    assert f([1]) == f([1]) == [[1], 1]
+    assert len(calls) == 2 and len(reads) == 0
+
+    # equal arguments of different types are cached separately
+    assert type(f(1.0)[0]) is float
+    assert type(f(True)[0]) is bool
+    assert len(calls) == 4
+
+    # ...including when they are nested
+    assert type(f((1,))[0][0]) is int
+    assert type(f((1.0,))[0][0]) is float
+    assert type(f((True,))[0][0]) is bool
+    assert len(calls) == 7
+
+    # results are still cached on disk, e.g., for later runs
+    f = decorate()
+    assert f(1, y=2) == [1, 2]
+    assert len(calls) == 7 and len(reads) == 1
+
+
+def test_cacher_kwargs_named_like_internal_args(tmp_path):
+    @cacher(cache_base=str(tmp_path))
+    def f(path_stats=None, hash_contents=None, cache_base=None):
+        return [path_stats, hash_contents, cache_base]
+
+    assert f(path_stats=1, hash_contents=2, cache_base=3) == [1, 2, 3]
+    assert f(path_stats=1, hash_contents=2, cache_base=3) == [1, 2, 3]
+
+    @iterator_cacher(cache_base=str(tmp_path))
+    def g(read_cache_sub=None, path_stats=None):
+        yield from [read_cache_sub, path_stats]
+
+    assert list(g(read_cache_sub=1, path_stats=2)) == [1, 2]
+    assert list(g(read_cache_sub=1, path_stats=2)) == [1, 2]
 
 
 def _json_iterator_read_cache_f(cache_path):
@@ -155,50 +348,172 @@ def _json_iterator_write_cache_f(values, cache_path):
             outf.write("\n")
 
 
-def test_iterator_cacher():
-    for read_f, write_f in (
-        (_json_iterator_read_cache_f, _json_iterator_write_cache_f),
-        (default_iterator_read_cache_f, default_iterator_write_cache_f),
+def test_default_iterator_cache_f(tmp_path):
+    cache_path = str(tmp_path / "cache")
+    a, b = "aaa", "bbb"
+    for values in (
+        [],
+        list(range(-5, 1000)),
+        # int64s are read in blocks of ITERATOR_BUFFER_SIZE bytes
+        list(range(ITERATOR_BUFFER_SIZE // 8 * 2)),
+        list(range(ITERATOR_BUFFER_SIZE // 8 * 2 + 1)),
+        [0, 2**63 - 1, -(2**63)],
+        [1, 2, 2**64, 3],
+        [1, True, 0, False],
+        [1, 2.0, "3", [4]],
+        ["a", 1, 2],
+        # values with shared references are pickled with memo references,
+        #   which mustn't resolve to objects from other values
+        [[a, a], [b, b], {"k": [a]}, (b, b)],
     ):
-        temp_dir = tempfile.mkdtemp()
-        _, path1 = tempfile.mkstemp()
-        _, path2 = tempfile.mkstemp()
-        _, kwargpath = tempfile.mkstemp()
+        default_iterator_write_cache_f(iter(values), cache_path)
+        read_values = list(default_iterator_read_cache_f(cache_path))
+        assert read_values == values
+        assert [type(v) for v in read_values] == [type(v) for v in values]
+
+
+ITERATOR_CACHE_FS = [
+    pytest.param(
+        _json_iterator_read_cache_f, _json_iterator_write_cache_f, id="json"
+    ),
+    pytest.param(
+        default_iterator_read_cache_f,
+        default_iterator_write_cache_f,
+        id="default",
+    ),
+    pytest.param(
+        msgpack_iterator_read_cache_f,
+        msgpack_iterator_write_cache_f,
+        id="msgpack",
+        marks=pytest.mark.skipif(msgpack is None, reason="needs msgpack"),
+    ),
+]
+
+
+@pytest.mark.parametrize("read_f,write_f", ITERATOR_CACHE_FS)
+def test_iterator_cacher(read_f, write_f, input_paths, tmp_path):
+    path1, path2, kwargpath = input_paths
+    temp_dir = str(tmp_path / "cache")
+
+    f_execution_times = {}
+
+    @iterator_cacher(
+        cache_base=temp_dir, write_cache_f=write_f, read_cache_f=read_f
+    )
+    def g(path, start_i, stop_i):
+        f_execution_times[(path, start_i, stop_i)] = time.time()
+        for i in range(start_i, stop_i):
+            yield i
+
+    _make_temp_file(path1)
+    _make_temp_file(path2)
+    # _make_temp_file(kwargpath)
+    args1 = (path1, 0, 5)
+    l1 = list(g(*args1))
+    g_last_ran_for_args1 = f_execution_times[args1]
+    l1_again = list(g(*args1))
+    assert l1 == l1_again
+    assert f_execution_times[args1] == g_last_ran_for_args1
+
+    args2 = (path2, 2, 4)
+    l2 = list(g(*args2))
+    g_last_ran_for_args2 = f_execution_times[args2]
+    os.utime(path2, None)
+    touched_l2 = list(g(*args2))
+    assert f_execution_times[args2] != g_last_ran_for_args2
+    assert l2 == touched_l2
+
+
+def test_iterator_cacher_failed_write(tmp_path):
+    fail = [True]
+
+    @iterator_cacher(cache_base=str(tmp_path))
+    def g(n):
+        for i in range(n):
+            if fail[0] and i == 2:
+                raise RuntimeError()
+            yield i
+
+    with pytest.raises(RuntimeError):
+        g(5)
+    # a partially written cache shouldn't be used
+    fail[0] = False
+    assert list(g(5)) == list(range(5))
+
+
+def test_cacher_stale_tmp_file(input_paths, tmp_path):
+    path1, _, _ = input_paths
+    calls = []
+
+    @cacher(cache_base=str(tmp_path / "cache"))
+    def f(path):
+        calls.append(path)
+
+    _make_temp_file(path1)
+    f(path1)
+    # e.g., left behind by a writer that was killed
+    (cache_dir,) = {
+        dirpath
+        for dirpath, _, filenames in os.walk(tmp_path / "cache")
+        if "cache" in filenames
+    }
+    with open(os.path.join(cache_dir, "cache.1.1.tmp"), "w"):
+        pass
+    time.sleep(0.01)
+    os.utime(path1, None)
+    f(path1)
+    assert len(calls) == 2
+    f(path1)
+    assert len(calls) == 2
 
-        try:
-            f_execution_times = {}
 
-            @iterator_cacher(
-                cache_base=temp_dir, write_cache_f=write_f, read_cache_f=read_f
-            )
-            def g(path, start_i, stop_i):
-                f_execution_times[(path, start_i, stop_i)] = time.time()
-                for i in range(start_i, stop_i):
-                    yield i
-
-            _make_temp_file(path1)
-            _make_temp_file(path2)
-            # _make_temp_file(kwargpath)
-            args1 = (path1, 0, 5)
-            l1 = list(g(*args1))
-            g_last_ran_for_args1 = f_execution_times[args1]
-            l1_again = list(g(*args1))
-            assert l1 == l1_again
-            assert f_execution_times[args1] == g_last_ran_for_args1
-
-            args2 = (path2, 2, 4)
-            l2 = list(g(*args2))
-            g_last_ran_for_args2 = f_execution_times[args2]
-            Path(path2).touch()
-            touched_l2 = list(g(*args2))
-            assert f_execution_times[args2] != g_last_ran_for_args2
-            assert l2 == touched_l2
+def test_prefetch_iterator():
+    assert list(prefetch_iterator(iter(range(100)), buffer_size=3)) == list(
+        range(100)
+    )
+
 
+def test_prefetch_iterator_exception():
+    def raises():
+        yield 1
+        raise KeyError("oops")
+
+    it = prefetch_iterator(raises())
+    assert next(it) == 1
+    with pytest.raises(KeyError):
+        next(it)
+
+
+def test_prefetch_iterator_close():
+    closed = threading.Event()
+
+    def infinite():
+        try:
+            i = 0
+            while True:
+                yield i
+                i += 1
         finally:
-            os.remove(path1)
-            os.remove(path2)
-            os.remove(kwargpath)
-            shutil.rmtree(temp_dir)
+            closed.set()
+
+    it = prefetch_iterator(infinite(), buffer_size=2)
+    assert next(it) == 0
+    it.close()
+    # the producer thread closes the wrapped iterator
+    assert closed.wait(timeout=5)
+
+
+def test_iterator_cacher_prefetch(tmp_path):
+    calls = []
+
+    @iterator_cacher(cache_base=str(tmp_path), prefetch=4)
+    def g(n):
+        calls.append(n)
+        yield from range(n)
+
+    assert list(g(10)) == list(range(10))
+    assert list(g(10)) == list(range(10))
+    assert calls == [10]
 
 
 def test_cacher_across_runs():
@@ -217,15 +532,22 @@ def test_cacher_across_runs():
                 bool_str = contents[0]
             if not bool_str in ("True", "False"):
                 raise ValueError()
-            return eval(bool_str)
-
-        Path(path).touch()
-        helper_script = os.path.join(
-            os.path.dirname((os.path.realpath(__file__))), "cache_helper.py"
+            return bool_str == "True"
+
+        os.utime(path, None)
+        helper_script = os.path.join(_THIS_DIR, "cache_helper.py")
+        # -S skips importing site, which accounts for a good part of
+        #   interpreter startup; cache_lib is found through PYTHONPATH instead
+        repo_root = os.path.dirname(os.path.dirname(helper_script))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, (repo_root, env.get("PYTHONPATH")))
         )
+        helper_cmd = [sys.executable, "-S", helper_script, temp_dir, path]
         result = _bool_from_out(
             subprocess.run(
-                ["python3", helper_script, temp_dir, path],
+                helper_cmd,
+                env=env,
                 capture_output=True,
                 check=True,
             )
@@ -233,16 +555,18 @@ def test_cacher_across_runs():
         assert result
         result = _bool_from_out(
             subprocess.run(
-                ["python3", helper_script, temp_dir, path],
+                helper_cmd,
+                env=env,
                 capture_output=True,
                 check=True,
             )
         )
         assert not result
-        Path(helper_script).touch()
+        os.utime(helper_script, None)
         result = _bool_from_out(
             subprocess.run(
-                ["python3", helper_script, temp_dir, path],
+                helper_cmd,
+                env=env,
                 capture_output=True,
                 check=True,
             )
@@ -251,3 +575,22 @@ def test_cacher_across_runs():
     finally:
         os.remove(path)
         shutil.rmtree(temp_dir)
+
+
+def test_cacher_serializer(tmp_path):
+    with pytest.raises(ValueError):
+        cacher(serializer="yaml")
+    with pytest.raises(ValueError):
+        cacher(backend="sqlite")
+    if orjson is None:
+        return
+    calls = []
+
+    @cacher(cache_base=str(tmp_path), serializer="orjson")
+    def f(x):
+        calls.append(x)
+        return {"x": [x, x]}
+
+    assert f(1) == {"x": [1, 1]}
+    assert f(1) == {"x": [1, 1]}
+    assert calls == [1]